@@ -1,35 +1,61 @@
 import streamlit as st
-import google.generativeai as genai
-import google.genai as genai_client
-from google.genai import types
-from pydantic import BaseModel, Field
-from typing import List, Dict, Any
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from typing import List, Dict, Any, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 import json
 import random
+import hashlib
+import tempfile
+import secrets
+import re
+import html
+import struct
+import queue
+import threading
+import time
+from pathlib import Path
 import os
 import base64
 from io import BytesIO
-import zipfile
-from PIL import Image
 
 from config.settings import GOOGLE_CLOUD_PROJECT_ID,GOOGLE_CLOUD_REGION
+from config.settings import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_FILES
+from config.settings import CAMPAIGN_CACHE_DIR, CAMPAIGN_CACHE_MAX_FILES
+from config.settings import TEXT_MODEL, IMAGEN_MODEL_V3, IMAGEN_MODEL_V4
 
 # Pydantic Models
+MODEL_CONFIG = ConfigDict(frozen=True, extra='ignore', str_strip_whitespace=True)
+
 class ColorPalette(BaseModel):
+    model_config = MODEL_CONFIG
+
     primary: str = Field(description="Primary color with hex code")
     secondary: str = Field(description="Secondary color with hex code")
     accent: str = Field(description="Accent color with hex code")
 
 class CampaignAsset(BaseModel):
+    model_config = MODEL_CONFIG
+
     slogan: str = Field(description="Creative campaign slogan")
     image_prompt: str = Field(description="Detailed image generation prompt")
     color_palette: ColorPalette
     font_recommendation: str = Field(description="Recommended font name")
 
 class CampaignVariants(BaseModel):
+    model_config = MODEL_CONFIG
+
     variant_a: CampaignAsset
     variant_b: CampaignAsset
 
+class BatchedCampaignVariants(CampaignVariants):
+    brief_id: int = Field(description="Number of the brief these variants are for")
+
+# Built once so repeated parses reuse the compiled validators
+VARIANTS_ADAPTER = TypeAdapter(CampaignVariants)
+BATCHED_VARIANTS_ADAPTER = TypeAdapter(list[BatchedCampaignVariants])
+
 
 # App Configuration
 st.set_page_config(
@@ -43,11 +69,32 @@ if 'generated_variants' not in st.session_state:
     st.session_state.generated_variants = None
 if 'generated_images' not in st.session_state:
     st.session_state.generated_images = {}
-if 'genai_client' not in st.session_state:
-    st.session_state.genai_client = None
+if 'metrics' not in st.session_state:
+    st.session_state.metrics = None
+if 'campaign_id' not in st.session_state:
+    st.session_state.campaign_id = None
+if 'campaign_brief' not in st.session_state:
+    st.session_state.campaign_brief = None
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str, project_id: str, location: str):
+    """Create the GenAI Client once per server so its connection pool is reused.
+
+    Uses Vertex AI (project and location) when GOOGLE_GENAI_USE_VERTEXAI is
+    set, otherwise the Gemini API key.
+    """
+    import google.genai as genai_client
+
+    if os.getenv("GOOGLE_GENAI_USE_VERTEXAI", "").lower() in ("1", "true"):
+        return genai_client.Client(
+            vertexai=True,
+            project=project_id,
+            location=location
+        )
+    return genai_client.Client(api_key=api_key)
 
 def configure_api():
-    """Configure Gemini API and GenAI Client"""
+    """Configure Gemini API and return the GenAI Client (None on failure)"""
     # Load API keys
     try:
         from dotenv import load_dotenv
@@ -71,96 +118,221 @@ def configure_api():
         # location = st.selectbox("Location", ["us-central1", "us-east1", "us-west1"], index=0)
         
     if GEMINI_API_KEY and project_id:
-        # Configure traditional Gemini API
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        # Configure GenAI Client for Imagen
+        # Configure GenAI Client for Gemini and Imagen
         try:
-            client = genai_client.Client(
-                project=project_id,
-                location=location
-            )
-            st.session_state.genai_client = client
-            return True
+            return get_genai_client(GEMINI_API_KEY, project_id, location)
         except Exception as e:
             st.error(f"Error configuring GenAI Client: {e}")
             st.info("Make sure you have set the project ID and location correctly in your .env file.")
-            return False
-    return False
+            return None
+    return None
 
-def generate_campaign_variants(brief: str) -> CampaignVariants:
-    """Generate multiple campaign variants using Gemini"""
-    
-    prompt = f"""
-    You are a creative marketing assistant. Based on the following creative brief, generate 2 distinct campaign variants (A, B) with different creative approaches.
-
-    Creative Brief: {brief}
-
-    For each variant, provide:
-    1. A unique campaign slogan
-    2. A detailed image generation prompt (describe visual style, colors, mood, elements)
-    3. A color palette with 3 hex colors (primary, secondary, accent)
-    4. A font recommendation
-
-    Make each variant distinctly different in tone and approach:
-    - Variant A: Bold and direct approach
-    - Variant B: Creative and artistic approach
-
-    Return your response in this exact JSON format:
-    {{
-        "variant_a": {{
-            "slogan": "campaign slogan here",
-            "image_prompt": "detailed image description here",
-            "color_palette": {{
-                "primary": "#hexcode",
-                "secondary": "#hexcode", 
-                "accent": "#hexcode"
-            }},
-            "font_recommendation": "font name"
-        }},
-        "variant_b": {{
-            "slogan": "campaign slogan here",
-            "image_prompt": "detailed image description here",
-            "color_palette": {{
-                "primary": "#hexcode",
-                "secondary": "#hexcode",
-                "accent": "#hexcode"
-            }},
-            "font_recommendation": "font name"
-        }}
-    }}
+# Static instructions are kept separate from the brief and sent as the
+# system instruction; the user turn carries only the brief.
+SYSTEM_INSTRUCTION = """
+You are a creative marketing assistant. Based on the creative brief you are given, generate 2 distinct campaign variants (A, B) with different creative approaches.
+
+For each variant, provide:
+1. A unique campaign slogan
+2. A detailed image generation prompt (describe visual style, colors, mood, elements)
+3. A color palette with 3 hex colors (primary, secondary, accent)
+4. A font recommendation
+
+Make each variant distinctly different in tone and approach:
+- Variant A: Bold and direct approach
+- Variant B: Creative and artistic approach
+"""
+
+# Upper bound on waiting for a (possibly batched) variants request
+VARIANT_TIMEOUT_SECONDS = 60
+
+class VariantGenerationError(Exception):
+    """Raised when Gemini's response can't be parsed into campaign variants"""
+
+    def __init__(self, message: str, raw_response: str = ""):
+        super().__init__(message)
+        self.raw_response = raw_response
+
+
+def _request_variants(client, briefs: List[str]) -> Dict[int, Dict[str, Any]]:
+    """Ask Gemini for variants for one or more briefs in a single call.
+
+    Returns the validated variants as plain dicts keyed by brief index.
     """
+    if len(briefs) == 1:
+        prompt = f"Creative Brief: {briefs[0]}"
+        schema = CampaignVariants
+    else:
+        numbered = "\n".join(f"[{i}] Creative Brief: {brief}" for i, brief in enumerate(briefs))
+        prompt = (
+            "Generate variants separately for each of the following creative briefs. "
+            "Return one entry per brief, with brief_id set to the brief's number.\n\n"
+            f"{numbered}"
+        )
+        # google-genai only accepts builtin list[...] generics as schemas
+        schema = list[BatchedCampaignVariants]
+
+    from google.genai import types
+
+    response = client.models.generate_content(
+        model=TEXT_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION,
+            response_mime_type="application/json",
+            response_schema=schema
+        )
+    )
 
-    model = genai.GenerativeModel('gemini-2.0-flash')
-    response = model.generate_content(prompt)
-    
-    # Parse JSON response
-    json_str = response.text.strip()
-    if json_str.startswith('```json'):
-        json_str = json_str[7:-3]
-    elif json_str.startswith('```'):
-        json_str = json_str[3:-3]
-    
     try:
-        data = json.loads(json_str)
-        return CampaignVariants(**data)
+        if len(briefs) == 1:
+            return {0: VARIANTS_ADAPTER.validate_json(response.text).model_dump()}
+        entries = BATCHED_VARIANTS_ADAPTER.validate_json(response.text)
     except Exception as e:
-        st.error(f"Error parsing response: {e}")
-        st.error(f"Raw response: {response.text}")
-        return None
+        raise VariantGenerationError(f"Error parsing response: {e}", response.text) from e
 
-def generate_image(prompt: str, variant_name: str) -> bytes:
-    """Generate image using Imagen model via GenAI Client"""
-    if not st.session_state.genai_client:
-        st.error("GenAI Client not configured. Please check your API settings.")
-        return None
-        
+    # Results are routed back to callers by brief_id, so it must match exactly
+    if sorted(entry.brief_id for entry in entries) != list(range(len(briefs))):
+        raise VariantGenerationError("Batched response brief ids don't match the briefs sent", response.text)
+    return {entry.brief_id: entry.model_dump(exclude={'brief_id'}) for entry in entries}
+
+class VariantBatcher:
+    """Coalesces briefs submitted close together into a single Gemini call.
+
+    A daemon thread waits for the first brief, collects more for up to
+    max_wait seconds (or until max_batch_size), then hands the batch to a
+    worker pool, so several batches can be in flight at once. Results are
+    fanned back out to each caller's Future.
+
+    Note: a batch merges briefs from different users' sessions into one
+    prompt. brief_ids are checked for repeats and gaps, but if the model
+    swaps two briefs' variants one user can receive output written from
+    another user's brief. Keep that in mind before relying on it for
+    briefs that must stay private.
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.25, max_workers: int = 4):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="variant-request")
+        threading.Thread(target=self._run, name="variant-batcher", daemon=True).start()
+
+    def submit(self, brief: str, client) -> Future:
+        future = Future()
+        self._queue.put((brief, client, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._process, batch)
+
+    def _process(self, batch):
+        # Every caller passes the same shared client, so use the first one
+        client = batch[0][1]
+        if len(batch) == 1:
+            brief, _, future = batch[0]
+            self._process_single(client, brief, future)
+            return
+
+        try:
+            results = _request_variants(client, [brief for brief, _, _ in batch])
+        except Exception:
+            # Malformed or mislabelled batch - retry each brief on its own,
+            # concurrently (queued without waiting, so the pool can't deadlock)
+            for brief, _, future in batch:
+                self._executor.submit(self._process_single, client, brief, future)
+            return
+
+        for i, (_, _, future) in enumerate(batch):
+            future.set_result(results[i])
+
+    def _process_single(self, client, brief: str, future: Future):
+        try:
+            future.set_result(_request_variants(client, [brief])[0])
+        except Exception as e:
+            future.set_exception(e)
+
+@st.cache_resource(show_spinner=False)
+def get_variant_batcher() -> VariantBatcher:
+    """One batcher per server so briefs from concurrent sessions are merged"""
+    return VariantBatcher()
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def generate_campaign_variants(brief: str, _client) -> Dict[str, Any]:
+    """Generate multiple campaign variants using Gemini.
+
+    Returns the validated variants as a plain dict so Streamlit can cache it
+    per brief; rebuild with VARIANTS_ADAPTER.validate_python(data). Failures raise
+    VariantGenerationError, which is never cached.
+    """
+    future = get_variant_batcher().submit(brief, _client)
     try:
-        client = st.session_state.genai_client
-        model_name = 'models/imagen-4.0-generate-preview-06-06'  # Using the more stable model
-        
-        # st.info(f"Generating image with {model_name} for prompt: '{prompt[:50]}...'")
-        
+        return future.result(timeout=VARIANT_TIMEOUT_SECONDS)
+    except FutureTimeoutError as e:
+        raise VariantGenerationError("Timed out waiting for campaign variants.") from e
+
+class ImageGenerationError(Exception):
+    """Raised when Imagen does not return usable image data"""
+
+
+def _extract_image_bytes(response) -> bytes:
+    """Pull the first image's bytes out of an Imagen response"""
+    if response.generated_images and len(response.generated_images) > 0:
+        generated_image = response.generated_images[0]
+        if generated_image.image and generated_image.image.image_bytes:
+            return generated_image.image.image_bytes
+        raise ImageGenerationError("No image data in generated response.")
+
+    error_msg = "No images were generated."
+    if hasattr(response, 'filters') and response.filters:
+        error_msg += f" Safety filters may have blocked content: {response.filters}"
+    raise ImageGenerationError(error_msg)
+
+# Tried in order; the first model that returns an image wins
+IMAGEN_MODELS = (f"models/{IMAGEN_MODEL_V4}", f"models/{IMAGEN_MODEL_V3}")
+
+# Max in-flight Imagen requests across all sessions on this server
+IMAGEN_MAX_CONCURRENCY = 5
+
+@st.cache_resource(show_spinner=False)
+def imagen_semaphore() -> threading.BoundedSemaphore:
+    """Server-wide limit so extra requests queue here instead of hitting 429s"""
+    return threading.BoundedSemaphore(IMAGEN_MAX_CONCURRENCY)
+
+def _is_transient(error: BaseException) -> bool:
+    """Server errors, rate limiting and timeouts are worth retrying"""
+    import httpx
+    from google.genai import errors as genai_errors
+
+    if isinstance(error, genai_errors.ServerError):
+        return True
+    if isinstance(error, genai_errors.ClientError):
+        return error.code == 429
+    # google-genai uses httpx, whose timeouts don't subclass the builtin TimeoutError
+    return isinstance(error, httpx.TimeoutException)
+
+@retry(
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+def _call_imagen(client, model_name: str, prompt: str) -> bytes:
+    """Request a single image from one Imagen model"""
+    from google.genai import types
+
+    with imagen_semaphore():
         response = client.models.generate_images(
             model=model_name,
             prompt=prompt,
@@ -171,54 +343,235 @@ def generate_image(prompt: str, variant_name: str) -> bytes:
                 person_generation="ALLOW_ADULT"
             )
         )
+    return _extract_image_bytes(response)
 
-        if response.generated_images and len(response.generated_images) > 0:
-            generated_image = response.generated_images[0]
-            if generated_image.image and generated_image.image.image_bytes:
-                return generated_image.image.image_bytes
-            else:
-                st.error("No image data in generated response.")
-                return None
-        else:
-            error_msg = "No images were generated."
-            if hasattr(response, 'filters') and response.filters:
-                error_msg += f" Safety filters may have blocked content: {response.filters}"
-            st.error(error_msg)
-            return None
+@st.cache_data(ttl=1800, max_entries=32, show_spinner=False)
+def generate_image(prompt: str, variant_name: str, _client) -> bytes:
+    """Generate image using Imagen model via GenAI Client.
 
-    except Exception as e:
-        st.error(f"Error generating image: {str(e)}")
-        
-        # Try fallback with imagen-4.0-generate-preview model
+    Raises ImageGenerationError instead of writing to the page, so it is
+    safe to call from worker threads. Results are cached per
+    (prompt, variant_name); the client is excluded from the cache key.
+    """
+    from google.genai import errors as genai_errors
+
+    client = _client
+    if not client:
+        raise ImageGenerationError("GenAI Client not configured. Please check your API settings.")
+
+    last_error = None
+    for model_name in IMAGEN_MODELS:
         try:
-            st.info("Trying fallback model: imagen-4.0-generate-preview-06-06...")
-            
-            response = client.models.generate_images(
-                model='models/imagen-4.0-generate-preview-06-06',
-                prompt=prompt,
-                config=types.GenerateImagesConfig(
-                    number_of_images=1,
-                    aspect_ratio="16:9",
-                    safety_filter_level="BLOCK_LOW_AND_ABOVE",
-                    person_generation="ALLOW_ADULT"
-                )
-            )
-            
-            if response.generated_images and len(response.generated_images) > 0:
-                generated_image = response.generated_images[0]
-                if generated_image.image and generated_image.image.image_bytes:
-                    return generated_image.image.image_bytes
-                    
-        except Exception as e2:
-            st.error(f"Both Imagen models failed. Error: {str(e2)}")
-            st.info("""
-            **Troubleshooting:**
-            - Ensure your Google Cloud Project has billing enabled
-            - Verify Vertex AI API is enabled
-            - Check if Imagen models are available in your region
-            """)
-            
+            return _call_imagen(client, model_name, prompt)
+        except ImageGenerationError:
+            raise
+        except Exception as e:
+            model_unavailable = isinstance(e, genai_errors.ClientError) and e.code == 404
+            if not (model_unavailable or _is_transient(e)):
+                # Bad requests, auth and the like would fail on every model too
+                if isinstance(e, genai_errors.APIError) and e.code in (401, 403):
+                    raise ImageGenerationError(f"Imagen request was not authorized: {e}") from e
+                raise ImageGenerationError(f"Error generating image: {e}") from e
+            # Model unavailable or still failing after retries - try the next one
+            last_error = e
+
+    raise ImageGenerationError(f"All Imagen models failed. Error: {last_error}") from last_error
+
+def generate_images_parallel(prompts: Dict[str, str], client) -> Tuple[Dict[str, bytes], Dict[str, str]]:
+    """Generate images for several variants concurrently.
+
+    Returns the images and the error messages, both keyed by variant name.
+    Each request runs to completion so one failure doesn't cancel the others.
+    """
+    images, errors = {}, {}
+    if not prompts:
+        return images, errors
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {
+            executor.submit(generate_image, prompt, variant_name, client): variant_name
+            for variant_name, prompt in prompts.items()
+        }
+        for future in as_completed(futures):
+            variant_name = futures[future]
+            try:
+                images[variant_name] = future.result()
+            except Exception as e:
+                errors[variant_name] = str(e)
+
+    return images, errors
+
+PREVIEW_WIDTH = 400
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _image_path(image_hash: str) -> Path:
+    return Path(IMAGE_CACHE_DIR) / f"{image_hash}.png"
+
+def _evict_lru(directory: str, pattern: str, max_files: int):
+    """Drop the least recently used files once a disk cache is over its limit"""
+    files = []
+    for path in Path(directory).glob(pattern):
+        try:
+            files.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue  # Removed by another session since the glob
+    files.sort()
+    for _, path in files[:max(0, len(files) - max_files)]:
+        path.unlink(missing_ok=True)
+
+def _atomic_write(path: Path, data: bytes):
+    """Write via a temp file in the same directory so readers never see a partial file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+def _mark_used(path: Path) -> bool:
+    """Refresh a cache file's mtime for LRU; False if it has been evicted.
+
+    Unlike Path.touch() this never recreates a deleted file as an empty one.
+    """
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def store_image(data: bytes) -> str:
+    """Write image bytes to the content-addressed disk cache and return their hash.
+
+    Session state only keeps the hash, so generated images don't sit in
+    server memory for the lifetime of every session.
+    """
+    image_hash = hashlib.sha256(data).hexdigest()
+    path = _image_path(image_hash)
+    if not _mark_used(path):
+        _atomic_write(path, data)
+        _evict_lru(IMAGE_CACHE_DIR, "*.png", IMAGE_CACHE_MAX_FILES)
+    return image_hash
+
+def load_image(image_hash: str) -> bytes:
+    """Read image bytes back from the disk cache (raises FileNotFoundError if evicted)"""
+    path = _image_path(image_hash)
+    data = path.read_bytes()
+    _mark_used(path)
+    return data
+
+def new_campaign_id() -> str:
+    """Short, URL-friendly random id for one generated campaign.
+
+    Random rather than derived from the brief, so two sessions generating
+    from the same brief never share (and overwrite) a campaign file.
+    """
+    return secrets.token_hex(6)
+
+def _campaign_path(campaign_id: str) -> Path:
+    return Path(CAMPAIGN_CACHE_DIR) / f"{campaign_id}.json"
+
+def save_campaign():
+    """Persist the current campaign so ?cid= links restore it without regenerating"""
+    campaign_id = st.session_state.campaign_id
+    if not campaign_id or not st.session_state.generated_variants:
+        return
+
+    campaign = json.dumps({
+        "brief": st.session_state.campaign_brief,
+        "variants": st.session_state.generated_variants.model_dump(),
+        "images": st.session_state.generated_images,
+        "metrics": st.session_state.metrics,
+    })
+    _atomic_write(_campaign_path(campaign_id), campaign.encode("utf-8"))
+    _evict_lru(CAMPAIGN_CACHE_DIR, "*.json", CAMPAIGN_CACHE_MAX_FILES)
+
+def load_campaign(campaign_id: str) -> bool:
+    """Hydrate session state from a saved campaign; False if it's missing or malformed"""
+    if not re.fullmatch(r"[0-9a-f]{12}", campaign_id):
+        return False
+    path = _campaign_path(campaign_id)
+    try:
+        campaign = json.loads(path.read_text())
+        brief = campaign["brief"]
+        if not isinstance(brief, str):
+            raise TypeError("brief must be a string")
+        variants = VARIANTS_ADAPTER.validate_python(campaign["variants"])
+        images = {}
+        for name, image_hash in campaign["images"].items():
+            if not re.fullmatch(r"[0-9a-f]{64}", image_hash):
+                raise ValueError(f"Invalid image hash for variant {name}")
+            # Skip images the disk cache has since evicted so they can be regenerated
+            if _image_path(image_hash).exists():
+                images[name] = image_hash
+        metrics = tuple(campaign["metrics"]) if campaign["metrics"] else None
+        if metrics is not None and (
+            len(metrics) != 2
+            or not all({'ctr', 'engagement', 'conversion'} <= set(m) for m in metrics)
+        ):
+            raise ValueError("Expected ctr/engagement/conversion metrics for two variants")
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # ValueError also covers JSON decode and pydantic validation errors
+        return False
+    _mark_used(path)
+
+    st.session_state.campaign_id = campaign_id
+    st.session_state.campaign_brief = st.session_state.brief = brief
+    st.session_state.generated_variants = variants
+    st.session_state.generated_images = images
+    st.session_state.metrics = metrics
+    return True
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def make_preview(image_hash: str, width: int) -> bytes:
+    """Return a Lanczos-downscaled PNG preview of a stored image.
+
+    Cached per image hash so reruns don't resample again.
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(load_image(image_hash)))
+    preview = image.copy()
+    preview.thumbnail((width, width), Image.Resampling.LANCZOS)
+
+    buffer = BytesIO()
+    preview.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def read_png_size(image_hash: str) -> Optional[Tuple[int, int]]:
+    """Read a stored PNG's dimensions from its IHDR chunk without decoding it"""
+    with _image_path(image_hash).open('rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or not header.startswith(PNG_SIGNATURE):
         return None
+    return struct.unpack('>II', header[16:24])
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_images_zip(images: Tuple[Tuple[str, str], ...]) -> bytes:
+    """Bundle stored images into a ZIP, cached per (variant, hash) set.
+
+    PNGs are already compressed, so they are stored as-is. Raises
+    FileNotFoundError if an image has been evicted from the disk cache.
+    """
+    import zipfile
+
+    zip_buffer = BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+        for variant_name, image_hash in images:
+            zip_file.write(_image_path(image_hash), f"variant_{variant_name}_image.png")
+    return zip_buffer.getvalue()
+
+def show_image_error(variant_name: str, error: str):
+    """Report a failed image generation with troubleshooting hints"""
+    st.error(f"Failed to generate image for Variant {variant_name}: {error}")
+    st.info("""
+    **Troubleshooting:**
+    - Ensure your Google Cloud Project has billing enabled
+    - Verify Vertex AI API is enabled
+    - Check if Imagen models are available in your region
+    """)
 
 def simulate_performance_metrics():
     """Generate simulated A/B testing metrics"""
@@ -228,7 +581,24 @@ def simulate_performance_metrics():
         'conversion': round(random.uniform(1.2, 4.8), 2)
     }
 
-def display_variant_card(variant: CampaignAsset, variant_name: str, metrics: Dict):
+SWATCH_TEMPLATE = """<div style="flex: 1;">
+    <div style="background-color: {swatch};
+                height: 50px;
+                border-radius: 5px;
+                border: 1px solid #ddd;
+                margin-bottom: 5px;">
+    </div>
+    <small>{label}<br>{color}</small>
+</div>"""
+
+HEX_COLOR_PATTERN = re.compile(r"#(?:[0-9a-fA-F]{8}|[0-9a-fA-F]{6}|[0-9a-fA-F]{3,4})\b")
+
+def _css_color(color: str) -> str:
+    """Pull the hex code out of a model-written color so only it reaches the style attribute"""
+    match = HEX_COLOR_PATTERN.search(color)
+    return match.group(0) if match else "transparent"
+
+def display_variant_card(variant: CampaignAsset, variant_name: str, metrics: Dict, client):
     """Display a campaign variant card"""
     with st.container():
         st.subheader(f"🎯 Variant {variant_name}")
@@ -237,8 +607,7 @@ def display_variant_card(variant: CampaignAsset, variant_name: str, metrics: Dic
         
         with col1:
             # Slogan
-            st.markdown("**Campaign Slogan:**")
-            st.markdown(f"*\"{variant.slogan}\"*")
+            st.markdown(f"**Campaign Slogan:**\n\n*\"{variant.slogan}\"*")
 
              # Image prompt
             with st.expander("View Image Prompt"):
@@ -249,73 +618,90 @@ def display_variant_card(variant: CampaignAsset, variant_name: str, metrics: Dic
             if variant_name not in st.session_state.generated_images:
                 if st.button(f"Generate Image for Variant {variant_name}", key=f"gen_{variant_name}"):
                     with st.spinner(f"Generating image for Variant {variant_name}..."):
-                        image_data = generate_image(variant.image_prompt, variant_name)
-                        if image_data:
-                            st.session_state.generated_images[variant_name] = image_data
-                        else:
-                            st.error(f"Failed to generate image for Variant {variant_name}")
+                        try:
+                            image_data = generate_image(
+                                variant.image_prompt, variant_name, client
+                            )
+                            st.session_state.generated_images[variant_name] = store_image(image_data)
+                            save_campaign()
+                        except ImageGenerationError as e:
+                            show_image_error(variant_name, str(e))
             
             if variant_name in st.session_state.generated_images:
                 try:
-                    # Display the generated image
-                    image_data = st.session_state.generated_images[variant_name]
-                    
-                    # Convert bytes to PIL Image for display
-                    image = Image.open(BytesIO(image_data))
-                    st.image(image, width=400, caption=f"Generated by Imagen for Variant {variant_name}")
+                    # Display a downscaled preview; the full-res image is only for download
+                    image_hash = st.session_state.generated_images[variant_name]
+                    preview = make_preview(image_hash, PREVIEW_WIDTH)
+                    st.image(preview, width=PREVIEW_WIDTH, caption=f"Generated by Imagen for Variant {variant_name}")
                     
                     # Show image details
-                    st.caption(f"Image size: {image.size[0]}x{image.size[1]} pixels")
+                    size = read_png_size(image_hash)
+                    if size:
+                        st.caption(f"Image size: {size[0]}x{size[1]} pixels")
+                    
+                    # Only load the full-res bytes when a download is requested
+                    if st.button("Download Image", key=f"prepare_download_{variant_name}"):
+                        st.download_button(
+                            label="🖼️ Download as PNG",
+                            data=load_image(image_hash),
+                            file_name=f"variant_{variant_name}_image.png",
+                            mime="image/png",
+                            key=f"download_{variant_name}"
+                        )
                     
                 except Exception as e:
                     st.error(f"Error displaying image: {e}")
                     # Remove corrupted image data
                     del st.session_state.generated_images[variant_name]
+                    save_campaign()
             
            
         
         with col2:
             # Performance Metrics
             st.markdown("**📊 Simulated Performance:**")
-            st.metric("CTR", f"{metrics['ctr']}%")
-            st.metric("Engagement", f"{metrics['engagement']}%")
-            st.metric("Conversion", f"{metrics['conversion']}%")
+            st.dataframe(
+                [{
+                    "CTR": f"{metrics['ctr']}%",
+                    "Engagement": f"{metrics['engagement']}%",
+                    "Conversion": f"{metrics['conversion']}%",
+                }],
+                hide_index=True,
+                use_container_width=True
+            )
             
-            # Color Palette
-            st.markdown("**🎨 Color Palette:**")
+            # Color Palette and Font Recommendation in one block
             colors = [variant.color_palette.primary, 
                      variant.color_palette.secondary, 
                      variant.color_palette.accent]
             
-            color_cols = st.columns(3)
             labels = ['Primary', 'Secondary', 'Accent']
-            for i, (color, label) in enumerate(zip(colors, labels)):
-                with color_cols[i]:
-                    st.markdown(f"""
-                    <div style="background-color: {color}; 
-                                height: 50px; 
-                                border-radius: 5px; 
-                                border: 1px solid #ddd;
-                                margin-bottom: 5px;">
-                    </div>
-                    <small>{label}<br>{color}</small>
-                    """, unsafe_allow_html=True)
-            
-            # Font Recommendation
-            st.markdown("**✍️ Font Recommendation:**")
-            st.write(variant.font_recommendation)
+            swatches = "".join(
+                SWATCH_TEMPLATE.format(
+                    swatch=_css_color(color), color=html.escape(color, quote=True), label=label
+                )
+                for color, label in zip(colors, labels)
+            )
+            st.markdown(
+                "**🎨 Color Palette:**\n\n"
+                f'<div style="display: flex; gap: 8px;">{swatches}</div>\n\n'
+                "**✍️ Font Recommendation:**\n\n"
+                f"{html.escape(variant.font_recommendation)}",
+                unsafe_allow_html=True
+            )
 
 def main():
     st.title("🎨 GenAI Content Assistant")
     st.markdown("Generate campaign assets with AI-powered A/B testing variants")
     
     # API Configuration
-    if not configure_api():
+    client = configure_api()
+    if not client:
         st.warning("⚠️ Please configure your API settings in the sidebar to continue.")
         st.markdown("""
         **Required Setup:**
-        1. **Gemini API Key** - For text generation (Gemini 2.0 Flash)
-        2. **Google Cloud Project ID** - For image generation (Imagen models)
+        1. **Gemini API Key** - Authenticates text and image generation
+        2. **Google Cloud Project ID** - Used instead of the key when `GOOGLE_GENAI_USE_VERTEXAI=true`
         
         **This app uses:**
         - **Gemini 2.0 Flash** for campaign text generation
@@ -328,12 +714,19 @@ def main():
         """)
         st.stop()
     
+    # Restore a shared or refreshed campaign from the URL
+    campaign_id = st.query_params.get("cid")
+    if campaign_id and campaign_id != st.session_state.campaign_id:
+        if not load_campaign(campaign_id):
+            del st.query_params["cid"]
+    
     # Main Input
     st.header("📝 Creative Brief Input")
     brief = st.text_area(
         "Enter your creative brief:",
         placeholder="Example: Launch promo for fantasy football app targeting Gen Z with meme culture and high-energy visuals.",
-        height=100
+        height=100,
+        key="brief"
     )
     
     # Generate Button
@@ -343,10 +736,21 @@ def main():
             return
         
         with st.spinner("Generating creative variants..."):
-            variants = generate_campaign_variants(brief)
+            try:
+                variants = VARIANTS_ADAPTER.validate_python(generate_campaign_variants(brief, client))
+            except VariantGenerationError as e:
+                st.error(str(e))
+                if e.raw_response:
+                    st.error(f"Raw response: {e.raw_response}")
+                variants = None
             if variants:
                 st.session_state.generated_variants = variants
                 st.session_state.generated_images = {}  # Reset images
+                st.session_state.metrics = (simulate_performance_metrics(), simulate_performance_metrics())
+                st.session_state.campaign_brief = brief
+                st.session_state.campaign_id = new_campaign_id()
+                st.query_params["cid"] = st.session_state.campaign_id
+                save_campaign()
                 st.success("Campaign variants generated successfully!")
             else:
                 st.error("Failed to generate variants. Please try again.")
@@ -358,18 +762,37 @@ def main():
         
         variants = st.session_state.generated_variants
         
-        # Generate simulated metrics for each variant
-        metrics_a = simulate_performance_metrics()
-        metrics_b = simulate_performance_metrics()
+        # Simulated metrics are computed once per set of variants, not per rerun
+        if st.session_state.metrics is None:
+            st.session_state.metrics = (simulate_performance_metrics(), simulate_performance_metrics())
+        metrics_a, metrics_b = st.session_state.metrics
+        
+        # Generate images for all variants at once
+        pending_prompts = {
+            name: variant.image_prompt
+            for name, variant in (("A", variants.variant_a), ("B", variants.variant_b))
+            if name not in st.session_state.generated_images
+        }
+        if pending_prompts and st.button("🚀 Generate All Images"):
+            with st.spinner("Generating images for all variants..."):
+                images, errors = generate_images_parallel(
+                    pending_prompts, client
+                )
+            st.session_state.generated_images.update(
+                {name: store_image(data) for name, data in images.items()}
+            )
+            save_campaign()
+            for variant_name, error in sorted(errors.items()):
+                show_image_error(variant_name, error)
         
         # Display variants in tabs
         tab1, tab2 = st.tabs(["Variant A (Bold and direct)", "Variant B (Creative and artistic)"])
         
         with tab1:
-            display_variant_card(variants.variant_a, "A", metrics_a)
+            display_variant_card(variants.variant_a, "A", metrics_a, client)
         
         with tab2:
-            display_variant_card(variants.variant_b, "B", metrics_b)
+            display_variant_card(variants.variant_b, "B", metrics_b, client)
         
         
         # Recommendation
@@ -389,8 +812,8 @@ def main():
         with col1:
             if st.button("Download Campaign Brief (JSON)"):
                 export_data = {
-                    "creative_brief": brief,
-                    "variants": st.session_state.generated_variants.dict(),
+                    "creative_brief": st.session_state.campaign_brief,
+                    "variants": st.session_state.generated_variants.model_dump(),
                     "performance_simulation": {
                         "variant_a": metrics_a,
                         "variant_b": metrics_b,
@@ -412,19 +835,26 @@ def main():
                 if st.button("Download Generated Images"):
                     
                     
-                    # Create a zip file with all generated images
-                    zip_buffer = BytesIO()
-                    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-                        for variant_name, image_data in st.session_state.generated_images.items():
-                            zip_file.writestr(f"variant_{variant_name}_image.png", image_data)
+                    zip_key = tuple(sorted(st.session_state.generated_images.items()))
+                    try:
+                        zip_data = build_images_zip(zip_key)
+                    except FileNotFoundError:
+                        zip_data = None
+                        # Forget images the disk cache has evicted so they can be regenerated
+                        st.session_state.generated_images = {
+                            name: image_hash
+                            for name, image_hash in st.session_state.generated_images.items()
+                            if _image_path(image_hash).exists()
+                        }
+                        st.error("Some images are no longer available. Please generate them again.")
                     
-                    zip_buffer.seek(0)
-                    st.download_button(
-                        label="📸 Download Images (ZIP)",
-                        data=zip_buffer.getvalue(),
-                        file_name="campaign_images.zip",
-                        mime="application/zip"
-                    )
+                    if zip_data:
+                        st.download_button(
+                            label="📸 Download Images (ZIP)",
+                            data=zip_data,
+                            file_name="campaign_images.zip",
+                            mime="application/zip"
+                        )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,4 +3,9 @@ IMAGEN_MODEL_V3 ="imagen-3.0-generate-002"
 IMAGEN_MODEL_V4 = "imagen-4.0-generate-preview-06-06"
 
 GOOGLE_CLOUD_PROJECT_ID = "gen-lang-client-0441709835"
-GOOGLE_CLOUD_REGION = "us-central1"
\ No newline at end of file
+GOOGLE_CLOUD_REGION = "us-central1"
+IMAGE_CACHE_DIR = ".cache/img"
+IMAGE_CACHE_MAX_FILES = 200
+
+CAMPAIGN_CACHE_DIR = ".cache/campaigns"
+CAMPAIGN_CACHE_MAX_FILES = 500